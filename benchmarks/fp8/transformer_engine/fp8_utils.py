@@ -47,9 +47,14 @@ def get_dataloaders(model_name: str, batch_size: int = 16):
             return_tensors="pt",
         )
 
-    # Instantiate dataloaders.
+    # Instantiate dataloaders. Pinned host memory lets the H2D copies below overlap with compute.
     train_dataloader = DataLoader(
-        tokenized_datasets["train"], shuffle=True, collate_fn=collate_fn, batch_size=batch_size, drop_last=True
+        tokenized_datasets["train"],
+        shuffle=True,
+        collate_fn=collate_fn,
+        batch_size=batch_size,
+        drop_last=True,
+        pin_memory=True,
     )
     eval_dataloader = DataLoader(
         tokenized_datasets["validation"],
@@ -57,6 +62,7 @@ def get_dataloaders(model_name: str, batch_size: int = 16):
         collate_fn=collate_fn,
         batch_size=16,
         drop_last=True,
+        pin_memory=True,
     )
 
     return train_dataloader, eval_dataloader
@@ -102,15 +108,28 @@ def get_named_parameters(model):
     return {n: p for n, p in model.named_parameters()}
 
 
-def evaluate_model(model, dataloader, metric, accelerator=None):
+def evaluate_model(model, dataloader, metric, accelerator=None, use_inference_mode=False):
     "Turns model to .eval(), runs dataloader, calculates metric, then turns eval back on"
     model.eval()
-    for step, batch in enumerate(dataloader):
-        with torch.no_grad():
+    # Buffer predictions/references on the GPU and feed the metric once at the end: `add_batch` pulls its inputs to
+    # CPU, which would otherwise force a device sync on every step.
+    predictions_list, references_list = [], []
+    # One context for the whole loop instead of a push/pop per step. `inference_mode` additionally skips the
+    # version-counter and view-tracking bookkeeping that `no_grad` still pays per op, but tensors created under it
+    # can never be updated in-place -- FSDP/DeepSpeed lazily build their flat-param/gather state on the first
+    # forward -- so the shared default stays `no_grad` and only single-GPU callers opt in.
+    inference_context = torch.inference_mode if use_inference_mode else torch.no_grad
+    with inference_context():
+        for step, batch in enumerate(dataloader):
+            # Async H2D transfer; the forward on the default stream implicitly waits for the copy
+            batch = {k: v.to("cuda", non_blocking=True) for k, v in batch.items()}
             outputs = model(**batch)
-        predictions = outputs.logits.argmax(dim=-1)
-        references = batch["labels"]
-        if accelerator is not None and accelerator.num_processes > 1:
-            predictions, references = accelerator.gather_for_metrics((predictions, references))
-        metric.add_batch(predictions=predictions, references=references)
+            predictions = outputs.logits.argmax(dim=-1)
+            references = batch["labels"]
+            if accelerator is not None and accelerator.num_processes > 1:
+                predictions, references = accelerator.gather_for_metrics((predictions, references))
+            predictions_list.append(predictions)
+            references_list.append(references)
+    # The `.cpu()` on the concatenated tensors is the single device sync of the whole eval loop
+    metric.add_batch(predictions=torch.cat(predictions_list).cpu(), references=torch.cat(references_list).cpu())
     return metric.compute()
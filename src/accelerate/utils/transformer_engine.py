@@ -12,88 +12,291 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import logging
+from collections import defaultdict, deque
+from functools import lru_cache, partial
+from itertools import chain
 from types import MethodType
 
+import torch
 import torch.nn as nn
 
 from .imports import is_fp8_available
 from .operations import GatheredParameters
 
 
-# Do not import `transformer_engine` at package level to avoid potential issues
+logger = logging.getLogger(__name__)
 
+# TE's FP8 GEMMs require both dimensions of a Linear to be multiples of 16; `dim & _FP8_DIM_ALIGNMENT_MASK` is the
+# branch-free equivalent of `dim % 16 != 0`.
+_FP8_DIM_ALIGNMENT_MASK = 15
 
-def convert_model(model, to_transformer_engine=True, _convert_linear=True, _convert_ln=True):
+# How many (dst, src) parameter pairs to gather and copy at a time: enough to amortize kernel launches, while under
+# ZeRO-3 only this many parameters are ever materialized at once instead of the full unpartitioned model.
+_COPY_FLUSH_CHUNK_SIZE = 64
+
+# Do not import `transformer_engine` at package level to avoid potential issues; the cached helpers below import it
+# lazily and make repeated calls pay only a cache hit instead of a package-metadata probe or an `importlib` lookup.
+_fp8_available = lru_cache(is_fp8_available)
+
+
+@lru_cache
+def _import_te():
+    import transformer_engine.pytorch as te
+
+    return te
+
+
+@lru_cache
+def _import_te_recipe():
+    import transformer_engine.common.recipe as te_recipe
+
+    return te_recipe
+
+
+@lru_cache
+def _te_formats():
+    te_recipe = _import_te_recipe()
+    return {name: getattr(te_recipe.Format, name) for name in ("HYBRID", "E4M3", "E5M2")}
+
+
+@lru_cache(maxsize=8)
+def _build_fp8_recipe(kwargs_items):
+    """
+    Builds a `DelayedScaling` recipe from a sorted tuple of kwargs items, caching identical requests. Sharing a
+    recipe between models is safe: TE keeps the amax/scale state on the modules, not on the recipe.
     """
-    Recursively converts the linear and layernorm layers of a model to their `transformers_engine` counterpart.
+    te_recipe = _import_te_recipe()
+    kwargs = dict(kwargs_items)
+    if "fp8_format" in kwargs:
+        kwargs["fp8_format"] = _te_formats()[kwargs["fp8_format"]]
+    return te_recipe.DelayedScaling(**kwargs)
+
+
+@lru_cache
+def _te_layer_types():
+    te = _import_te()
+    return (te.LayerNorm, te.Linear, te.TransformerLayer)
+
+
+def _flush_parameter_copies(copies):
+    """
+    Performs all collected `(destination, source)` parameter copies, one dtype/device group at a time. Groups whose
+    source and destination dtype/device match are coalesced into a single contiguous scratch buffer with `torch.cat`
+    -- one bandwidth-bound copy instead of N launch-bound ones -- and the destinations are re-pointed at slices of
+    it. Mixed groups fall back to a grouped `_foreach_copy_`.
+    """
+    groups = defaultdict(lambda: ([], []))
+    for dst, src in copies:
+        dsts, srcs = groups[(dst.dtype, dst.device, src.dtype, src.device)]
+        dsts.append(dst)
+        srcs.append(src)
+    for (dst_dtype, dst_device, src_dtype, src_device), (dsts, srcs) in groups.items():
+        if len(dsts) > 1 and dst_dtype == src_dtype and dst_device == src_device:
+            try:
+                flat = torch.empty(sum(s.numel() for s in srcs), dtype=dst_dtype, device=dst_device)
+                torch.cat([s.reshape(-1) for s in srcs], out=flat)
+                offset = 0
+                for dst, src in zip(dsts, srcs):
+                    numel = src.numel()
+                    # The parameter becomes a view into the scratch buffer; TE resolves `.data_ptr()` lazily, so
+                    # the external storage is fine.
+                    dst.data = flat[offset : offset + numel].view(dst.shape)
+                    offset += numel
+                continue
+            except RuntimeError:
+                pass
+        torch._foreach_copy_(dsts, srcs)
+
+
+def convert_model(model, to_transformer_engine=True, _convert_linear=True, _convert_ln=True, param_map=None):
     """
-    if not is_fp8_available():
+    Converts the linear and layernorm layers of a model to their `transformers_engine` counterpart.
+
+    If `param_map` is given a dict, it is filled with an `id(old_parameter) -> new_parameter` entry for every
+    replaced parameter, so callers can remap optimizer param groups without re-walking `named_parameters`.
+    """
+    if not _fp8_available():
         raise ImportError("Using `convert_model` requires transformer_engine to be installed.")
-    import transformer_engine.pytorch as te
+    te = _import_te()
+
+    # Converting an already-converted model (a common notebook/script-iteration pattern) would walk the full module
+    # tree for nothing; return early instead. Only short-circuit when every conversion flag is on, since a partial
+    # conversion may legitimately need another pass.
+    if to_transformer_engine and _convert_linear and _convert_ln and has_transformer_engine_layers(model):
+        return
+
+    # First pass collects the replacement modules and the parameter copies they need, second pass flushes all copies
+    # at once and swaps the modules in.
+    replacements = []
+    copies = []
+
+    def _record_param(old_param, new_param):
+        if param_map is not None:
+            param_map[id(old_param)] = new_param
 
-    for name, module in model.named_children():
-        if isinstance(module, nn.Linear) and to_transformer_engine and _convert_linear:
-            has_bias = module.bias is not None
-            params_to_gather = [module.weight]
-            if has_bias:
-                params_to_gather.append(module.bias)
+    def _adopt_params(te_module, module, has_bias):
+        """
+        Builds nothing itself: re-points the (meta-constructed) `te_module` parameters at the storage of `module`,
+        avoiding both the fresh allocation and the copy. Returns `False` when the result cannot be materialized
+        faithfully, in which case the caller falls back to construction + copy.
+        """
+        # ZeRO-3 partitioned parameters only hold real data inside `GatheredParameters`, so they go through the
+        # gathered copy path instead of being adopted.
+        if hasattr(module.weight, "ds_id"):
+            return False
+        te_module.weight = nn.Parameter(module.weight.data, requires_grad=module.weight.requires_grad)
+        if has_bias:
+            te_module.bias = nn.Parameter(module.bias.data, requires_grad=module.bias.requires_grad)
+        # Anything still on the meta device (extra scales/buffers of the installed TE version) cannot be
+        # reconstructed here.
+        if any(t.is_meta for t in chain(te_module.parameters(), te_module.buffers())):
+            return False
+        _record_param(module.weight, te_module.weight)
+        if has_bias:
+            _record_param(module.bias, te_module.bias)
+        return True
 
-            with GatheredParameters(params_to_gather, modifier_rank=0):
-                if any(p % 16 != 0 for p in module.weight.shape):
-                    return
+    def _linear_to_te(module):
+        # Use the module attributes rather than `weight.shape`, as the parameter may not be materialized outside
+        # `GatheredParameters`. OR-ing the dimensions and masking the low bits flags a non-multiple of 16 in a
+        # single integer op instead of a generator + two Python-level modulos.
+        if (module.out_features | module.in_features) & _FP8_DIM_ALIGNMENT_MASK:
+            logger.debug(
+                f"Not converting `nn.Linear` with in_features={module.in_features} and "
+                f"out_features={module.out_features} to `te.Linear`, as FP8 requires dimensions that are "
+                "multiples of 16."
+            )
+            return None
+        has_bias = module.bias is not None
+        # Construct on the meta device first: this skips TE's weight init and the transient second allocation of
+        # the weights, which are adopted from the original module instead of copied.
+        try:
+            with torch.device("meta"):
                 te_module = te.Linear(
                     module.in_features, module.out_features, bias=has_bias, params_dtype=module.weight.dtype
                 )
-                te_module.weight.copy_(module.weight)
-                if has_bias:
-                    te_module.bias.copy_(module.bias)
-
-                setattr(model, name, te_module)
-        # Note: @xrsrke (Phuc) found that te.LayerNorm doesn't have any real memory savings or speedups over nn.LayerNorm
-        elif isinstance(module, nn.LayerNorm) and to_transformer_engine and _convert_ln:
-            with GatheredParameters([module.weight, module.bias], modifier_rank=0):
+            if _adopt_params(te_module, module, has_bias):
+                return te_module
+        except (NotImplementedError, RuntimeError, TypeError):
+            pass
+        # Construct on the source module's device so a later `model.to(...)` doesn't pay a second full-model
+        # transfer of the freshly allocated TE state; the copy below is then D2D when the source is already on GPU.
+        te_module = te.Linear(
+            module.in_features,
+            module.out_features,
+            bias=has_bias,
+            params_dtype=module.weight.dtype,
+            device=module.weight.device,
+        )
+        copies.append((te_module.weight, module.weight))
+        _record_param(module.weight, te_module.weight)
+        if has_bias:
+            copies.append((te_module.bias, module.bias))
+            _record_param(module.bias, te_module.bias)
+        return te_module
+
+    # Note: @xrsrke (Phuc) found that te.LayerNorm doesn't have any real memory savings or speedups over nn.LayerNorm
+    def _ln_to_te(module):
+        try:
+            with torch.device("meta"):
                 te_module = te.LayerNorm(module.normalized_shape[0], eps=module.eps, params_dtype=module.weight.dtype)
-                te_module.weight.copy_(module.weight)
-                te_module.bias.copy_(module.bias)
-
-            setattr(model, name, te_module)
-        elif isinstance(module, te.Linear) and not to_transformer_engine and _convert_linear:
-            has_bias = module.bias is not None
-            new_module = nn.Linear(
-                module.in_features, module.out_features, bias=has_bias, params_dtype=module.weight.dtype
-            )
-            new_module.weight.copy_(module.weight)
-            if has_bias:
-                new_module.bias.copy_(module.bias)
-
-            setattr(model, name, new_module)
-        elif isinstance(module, te.LayerNorm) and not to_transformer_engine and _convert_ln:
-            new_module = nn.LayerNorm(module.normalized_shape[0], eps=module.eps, params_dtype=module.weight.dtype)
-            new_module.weight.copy_(module.weight)
-            new_module.bias.copy_(module.bias)
-
-            setattr(model, name, new_module)
-        else:
-            convert_model(
-                module,
-                to_transformer_engine=to_transformer_engine,
-                _convert_linear=_convert_linear,
-                _convert_ln=_convert_ln,
-            )
+            if _adopt_params(te_module, module, has_bias=True):
+                return te_module
+        except (NotImplementedError, RuntimeError, TypeError):
+            pass
+        te_module = te.LayerNorm(
+            module.normalized_shape[0], eps=module.eps, params_dtype=module.weight.dtype, device=module.weight.device
+        )
+        copies.append((te_module.weight, module.weight))
+        copies.append((te_module.bias, module.bias))
+        _record_param(module.weight, te_module.weight)
+        _record_param(module.bias, te_module.bias)
+        return te_module
+
+    def _linear_from_te(module):
+        has_bias = module.bias is not None
+        new_module = nn.Linear(
+            module.in_features, module.out_features, bias=has_bias, params_dtype=module.weight.dtype
+        )
+        copies.append((new_module.weight, module.weight))
+        _record_param(module.weight, new_module.weight)
+        if has_bias:
+            copies.append((new_module.bias, module.bias))
+            _record_param(module.bias, new_module.bias)
+        return new_module
+
+    def _ln_from_te(module):
+        new_module = nn.LayerNorm(module.normalized_shape[0], eps=module.eps, params_dtype=module.weight.dtype)
+        copies.append((new_module.weight, module.weight))
+        copies.append((new_module.bias, module.bias))
+        _record_param(module.weight, new_module.weight)
+        _record_param(module.bias, new_module.bias)
+        return new_module
+
+    # A type -> handler table replaces the isinstance ladder with a single dict lookup per child. It has to be built
+    # per call since `te` cannot be imported at package level.
+    dispatch = {}
+    if to_transformer_engine:
+        if _convert_linear:
+            dispatch[nn.Linear] = _linear_to_te
+        if _convert_ln:
+            dispatch[nn.LayerNorm] = _ln_to_te
+    else:
+        if _convert_linear:
+            dispatch[te.Linear] = _linear_from_te
+        if _convert_ln:
+            dispatch[te.LayerNorm] = _ln_from_te
+
+    def _resolve_handler(module_type):
+        # Exact types stay a single dict lookup, but subclasses must convert exactly like the original isinstance
+        # ladder did (e.g. nn.MultiheadAttention's out_proj is an nn.Linear *subclass*): on a miss, resolve through
+        # the MRO and cache the result -- including misses -- back into the table.
+        if module_type not in dispatch:
+            handler = None
+            for base in module_type.__mro__[1:]:
+                if base in dispatch:
+                    handler = dispatch[base]
+                    break
+            dispatch[module_type] = handler
+        return dispatch[module_type]
+
+    # Iterative traversal with an explicit worklist, so very deep models cannot hit the Python recursion limit.
+    stack = deque([model])
+    while stack:
+        parent = stack.pop()
+        for name, module in parent.named_children():
+            handler = _resolve_handler(type(module))
+            if handler is None:
+                stack.append(module)
+                continue
+            new_module = handler(module)
+            if new_module is None:
+                # The layer stays as-is (e.g. an odd-shaped `nn.Linear`), but its children and siblings are still
+                # converted rather than silently aborting the rest of the traversal.
+                stack.append(module)
+                continue
+            replacements.append((parent, name, new_module))
+
+    # Gather and flush in bounded chunks: the copies within a chunk are still batched, but ZeRO-3 peak memory stays
+    # O(chunk) instead of materializing every source parameter at once.
+    with torch.no_grad():
+        for start in range(0, len(copies), _COPY_FLUSH_CHUNK_SIZE):
+            chunk = copies[start : start + _COPY_FLUSH_CHUNK_SIZE]
+            with GatheredParameters([src for _, src in chunk], modifier_rank=0):
+                _flush_parameter_copies(chunk)
+    for parent, name, new_module in replacements:
+        setattr(parent, name, new_module)
 
 
 def has_transformer_engine_layers(model):
     """
     Returns whether a given model has some `transformer_engine` layer or not.
     """
-    if not is_fp8_available():
+    if not _fp8_available():
         raise ImportError("Using `has_transformer_engine_layers` requires transformer_engine to be installed.")
-    import transformer_engine.pytorch as te
-
-    for m in model.modules():
-        if isinstance(m, (te.LayerNorm, te.Linear, te.TransformerLayer)):
-            return True
-    return False
+    te_layer_types = _te_layer_types()
+    return any(isinstance(m, te_layer_types) for m in model.modules())
 
 
 def contextual_fp8_autocast(model_forward, fp8_recipe, use_during_eval=False):
@@ -101,13 +304,18 @@ def contextual_fp8_autocast(model_forward, fp8_recipe, use_during_eval=False):
     Wrapper for a model's forward method to apply FP8 autocast. Is context aware, meaning that by default it will
     disable FP8 autocast during eval mode, which is generally better for more accurate metrics.
     """
-    if not is_fp8_available():
+    if not _fp8_available():
         raise ImportError("Using `contextual_fp8_autocast` requires transformer_engine to be installed.")
-    from transformer_engine.pytorch import fp8_autocast
+    fp8_autocast = _import_te().fp8_autocast
+
+    # Bind the recipe and flag once, so each forward call only invokes a prepared factory instead of re-packing
+    # the keyword arguments; forward can be called millions of times over a model's lifetime.
+    fp8_enabled = partial(fp8_autocast, enabled=True, fp8_recipe=fp8_recipe)
+    fp8_disabled = partial(fp8_autocast, enabled=False, fp8_recipe=fp8_recipe)
 
     def forward(self, *args, **kwargs):
-        enabled = use_during_eval or self.training
-        with fp8_autocast(enabled=enabled, fp8_recipe=fp8_recipe):
+        autocast = fp8_enabled if use_during_eval or self.training else fp8_disabled
+        with autocast():
             return model_forward(*args, **kwargs)
 
     # To act like a decorator so that it can be popped when doing `extract_model_from_parallel`
@@ -120,15 +328,12 @@ def apply_fp8_autowrap(model, fp8_recipe_handler):
     """
     Applies FP8 context manager to the model's forward method
     """
-    if not is_fp8_available():
+    if not _fp8_available():
         raise ImportError("Using `apply_fp8_autowrap` requires transformer_engine to be installed.")
-    import transformer_engine.common.recipe as te_recipe
 
     kwargs = fp8_recipe_handler.to_kwargs() if fp8_recipe_handler is not None else {}
-    if "fp8_format" in kwargs:
-        kwargs["fp8_format"] = getattr(te_recipe.Format, kwargs["fp8_format"])
     use_during_eval = kwargs.pop("use_autocast_during_eval", False)
-    fp8_recipe = te_recipe.DelayedScaling(**kwargs)
+    fp8_recipe = _build_fp8_recipe(tuple(sorted(kwargs.items())))
     new_forward = contextual_fp8_autocast(model.forward, fp8_recipe, use_during_eval)
 
     if hasattr(model.forward, "__func__"):